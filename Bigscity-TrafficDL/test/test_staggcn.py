@@ -0,0 +1,29 @@
+import importlib
+
+import torch
+
+# traffic_flow_prediction 包中的 STAGGCN 属性是模型类，这里取模块本身以便切换 SparseTensor
+staggcn = importlib.import_module('trafficdl.model.traffic_flow_prediction.STAGGCN')
+
+if __name__ == '__main__':
+    # 检查 STCell 中4层GATConv走 SparseTensor 形式的 adj_t 时，与直接使用 edge_index 的结果一致
+    assert staggcn.SparseTensor is not None, 'torch_sparse is required for this check'
+    torch.manual_seed(0)
+    node_num, seq_len, batch_size = 20, 12, 4
+    # 随机边集，包含自环和重复边，检验 adj_t 与 edge_index 两种路径对自环的处理一致
+    edge_index = torch.randint(0, node_num, (2, 80))
+    dtw_edge_index = torch.randint(0, node_num, (2, 80))
+    x = torch.randn(batch_size * node_num, seq_len)
+
+    cell = staggcn.STCell(node_num=node_num, seq_len=seq_len, choice=[0, 1, 1]).eval()
+    with torch.no_grad():
+        adj_t_output = cell(x, edge_index, dtw_edge_index)
+        print('adj_t cache:', {branch: type(adj_t).__name__ for branch, (_, adj_t) in cell._adj_t_cache.items()})
+        sparse_tensor = staggcn.SparseTensor
+        staggcn.SparseTensor = None
+        try:
+            edge_index_output = cell(x, edge_index, dtw_edge_index)
+        finally:
+            staggcn.SparseTensor = sparse_tensor
+    print(adj_t_output.shape, (adj_t_output - edge_index_output).abs().max().item())
+    assert torch.allclose(adj_t_output, edge_index_output, atol=1e-5)
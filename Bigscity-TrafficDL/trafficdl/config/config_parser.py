@@ -111,6 +111,9 @@ class ConfigParser(object):
             torch.cuda.set_device(gpu_id)
         self.config['device'] = torch.device(
             "cuda" if torch.cuda.is_available() and use_gpu else "cpu")
+        # 由cuDNN在首个batch对每种卷积形状实测并选出最快的算法，输入形状固定时收益明显
+        if self.config.get('cudnn_benchmark', False):
+            torch.backends.cudnn.benchmark = True
 
     def get(self, key, default=None):
         return self.config.get(key, default)
@@ -1,13 +1,18 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn.utils import weight_norm
+from torch.nn.utils import weight_norm, remove_weight_norm
 from torch_geometric.nn import GATConv
+try:
+    from torch_sparse import SparseTensor
+except ImportError:
+    SparseTensor = None
 from logging import getLogger
 from trafficdl.model import loss
 from trafficdl.model.abstract_traffic_state_model import AbstractTrafficStateModel
 import numpy as np
 import math
+import contextlib
 
 
 # 18373528 杨凌华
@@ -29,10 +34,14 @@ class STAGGCN(AbstractTrafficStateModel):
         self.feature_dim = self.data_feature.get('feature_dim', 1)  # 输入维度
         self.output_dim = self.data_feature.get('output_dim', 1)  # 输出维度
         # 以下两项是STAG-GCN对数据集额外进行预处理得到的边关系数据
+        # 注册为buffer，随model.to(device)一次性搬到对应设备上，不必在每个batch的forward中搬运
+        # persistent=False使其不写入state_dict，与旧的模型文件保持兼容
         # 对数据集预处理得到的空间邻接边集
-        self.edge_index = self.data_feature.get('edge_index', torch.tensor([[], []], dtype=torch.long))  # 空间邻接边
+        self.register_buffer('edge_index', self.data_feature.get(
+            'edge_index', torch.tensor([[], []], dtype=torch.long)), persistent=False)  # 空间邻接边
         # 对数据集预处理得到的语义邻接边集
-        self.dtw_edge_index = self.data_feature.get('dtw_edge_index', torch.tensor([[], []], dtype=torch.long))  # 语义邻接边
+        self.register_buffer('dtw_edge_index', self.data_feature.get(
+            'dtw_edge_index', torch.tensor([[], []], dtype=torch.long)), persistent=False)  # 语义邻接边
         # 3.初始化log用于必要的输出
         self._logger = getLogger()
         # 4.初始化device
@@ -46,6 +55,16 @@ class STAGGCN(AbstractTrafficStateModel):
         self.tcn_dim = config['tcn_dim']
         self.atten_head = config['atten_head']
         self.choice = config['choice']
+        self.low_rank_adj = config.get('low_rank_adj', False)
+        # 是否在GPU上把STCell的各分支放到独立的CUDA stream上并行执行
+        self.branch_streams = config.get('branch_streams', False)
+        # 是否在GPU上用BF16自动混合精度计算模型前向（需要torch>=1.10以及支持BF16的GPU）
+        self.use_bf16 = config.get('use_bf16', False)
+        if self.use_bf16 and (self.device.type != 'cuda' or not hasattr(torch, 'autocast')
+                              or (hasattr(torch.cuda, 'is_bf16_supported') and not torch.cuda.is_bf16_supported())):
+            self._logger.warning('use_bf16 requires a CUDA device with BF16 support and torch.autocast (torch>=1.10), '
+                                 'STAGGCN falls back to FP32.')
+            self.use_bf16 = False
         self.batch_size = config['batch_size']
         # 7.构造深度模型的层次结构
         self.model = STAGGCNModel(node_num=self.num_nodes,
@@ -54,7 +73,12 @@ class STAGGCN(AbstractTrafficStateModel):
                                   graph_dim=self.graph_dim,
                                   tcn_dim=self.tcn_dim,
                                   atten_head=self.atten_head,
-                                  choice=self.choice).to(self.device)
+                                  choice=self.choice,
+                                  low_rank_adj=self.low_rank_adj,
+                                  branch_streams=self.branch_streams).to(self.device)
+        # 8.可选：用torch.compile编译TCN，让TorchInductor把卷积后的切片、ReLU、Dropout、残差加法融合
+        if config.get('torch_compile', False):
+            self._compile_tcn()
 
     def forward(self, batch):
         """
@@ -66,19 +90,59 @@ class STAGGCN(AbstractTrafficStateModel):
         # 当然一般只需要取输入数据，例如X,X_ext，因为这个函数是用来计算输出的
         # 模型输入的数据的特征维度应该等于self.feature_dim
         x = batch['X']  # shape = (batch_size, input_length, ..., feature_dim)
-        x = x[:, :, :, 0].permute(0, 2, 1)
-        x = x.reshape(-1, x.shape[2])  # 将x维度变为 [batch*node_num, seq_len] 以适应源码模型的输入维度
+        # permute后显式contiguous，只在这里拷贝一次，之后的计算都在连续内存上进行
+        x = x[:, :, :, 0].permute(0, 2, 1).contiguous()
+        x = x.view(-1, x.shape[2])  # 将x维度变为 [batch*node_num, seq_len] 以适应源码模型的输入维度
         # 将模型的输入装入device
         x = x.to(self.device)
-        self.edge_index = self.edge_index.to(self.device)
-        self.dtw_edge_index = self.dtw_edge_index.to(self.device)
-        # 2.根据输入数据计算模型的输出结果
-        outputs = self.model(x, self.edge_index, self.dtw_edge_index)
+        # 2.根据输入数据计算模型的输出结果，开启use_bf16时在autocast下计算，输出转回FP32再参与反归一化和loss计算
+        autocast = torch.autocast('cuda', dtype=torch.bfloat16) if self.use_bf16 else contextlib.nullcontext()
+        with autocast:
+            outputs = self.model(x, self.edge_index, self.dtw_edge_index)
+        outputs = outputs.float()
         # 3.对源码模型的输出维度进行调整使其适应于框架模型的输出维度
-        outputs = torch.reshape(outputs, (self.batch_size, self.output_window, self.num_nodes, 1))
+        # 源码模型输出为 [batch*node_num, output_window]，先还原为 [batch, node_num, output_window]
+        # 再交换节点和时间维度得到 [batch, output_window, node_num, 1]
+        outputs = outputs.view(-1, self.num_nodes, self.output_window).unsqueeze(-1).transpose(1, 2).contiguous()
         # 4.返回输出结果
         return outputs
 
+    def _compile_tcn(self):
+        """
+        用torch.compile编译TCN的forward（替换实例上的forward而不包装模块本身，保持state_dict的key不变）
+        torch.compile是惰性的，编译器缺失等错误要到第一次forward时才会抛出，
+        因此第一次调用编译后的forward时若出错，记录日志、恢复eager模式的forward并用eager重新计算这一次
+        """
+        if self.choice[0] != 1:
+            return
+        if not hasattr(torch, 'compile'):
+            self._logger.warning('torch.compile is unavailable (torch<2.0), STAGGCN TCN runs in eager mode.')
+            return
+        tcn = self.model.STCell.tcn
+        compiled_forward = torch.compile(tcn.forward)
+        logger = self._logger
+
+        def first_forward(x):
+            try:
+                output = compiled_forward(x)
+            except Exception as e:
+                logger.warning('torch.compile failed on the first forward ({}), '
+                               'STAGGCN TCN runs in eager mode.'.format(e))
+                del tcn.forward  # 恢复为类上定义的eager forward
+                return tcn.forward(x)
+            tcn.forward = compiled_forward
+            return output
+
+        tcn.forward = first_forward
+
+    def fuse_for_inference(self):
+        """
+        训练结束后、推理前调用一次，把TCN中各层卷积的 weight_norm 合并为普通权重
+        """
+        for module in self.modules():
+            if isinstance(module, TemporalBlock):
+                module.fuse_for_inference()
+
     def calculate_loss(self, batch):
         """
         输入一个batch的数据，返回训练过程这个batch数据的loss，也就是需要定义一个loss函数。
@@ -110,7 +174,7 @@ class STAGGCN(AbstractTrafficStateModel):
 
 class STAGGCNModel(nn.Module):
     def __init__(self, node_num=325, seq_len=12, pred_len=6, graph_dim=32,
-                 tcn_dim=[10], atten_head=4, choice=[1, 1, 1]):
+                 tcn_dim=[10], atten_head=4, choice=[1, 1, 1], low_rank_adj=False, branch_streams=False):
         super(STAGGCNModel, self).__init__()
         self.node_num = node_num
         self.seq_len = seq_len
@@ -118,7 +182,8 @@ class STAGGCNModel(nn.Module):
         self.graph_dim = graph_dim
         # self.output_dim = seq_len + np.sum(choice) * graph_dim
         self.output_dim = np.sum(choice) * graph_dim
-        self.STCell = STCell(node_num, seq_len, graph_dim, tcn_dim, choice=choice, atten_head=atten_head)
+        self.STCell = STCell(node_num, seq_len, graph_dim, tcn_dim, choice=choice, atten_head=atten_head,
+                             low_rank_adj=low_rank_adj, branch_streams=branch_streams)
         self.output_linear = nn.Linear(in_features=self.output_dim, out_features=self.pred_len)
         # self.output_linear_0 = nn.Linear(in_features=self.graph_dim, out_features=256)
         # self.output_linear_1 = nn.Linear(in_features=256, out_features=self.pred_len)
@@ -136,13 +201,62 @@ class STAGGCNModel(nn.Module):
         return output
 
 
+def node_matmul(matrix, x):
+    """
+    计算 matrix @ x，其中 matrix 为 [out_num, node_num]，x 为 [batch, node_num, dim]
+    直接用 matmul 广播会把 matrix 复制 batch 份再做 bmm，这里把 batch 并入列维度，只做一次 GEMM
+    """
+    batch, node_num, dim = x.shape
+    output = matrix.mm(x.transpose(0, 1).reshape(node_num, batch * dim))
+    return output.view(matrix.shape[0], batch, dim).transpose(0, 1).contiguous()
+
+
+def learned_propagation(source_embed, target_embed, low_rank=False):
+    """
+    返回 x -> learned_matrix @ x 的函数，learned_matrix = softmax(relu(S @ T)) 每次forward只构造一次，供各层共用
+    low_rank 为 True 时用 row_norm(relu(S) @ relu(T)) 近似 learned_matrix（行归一化的线性注意力），
+    按 relu(S) @ (relu(T) @ x) 的顺序计算，不生成 [node_num, node_num] 的矩阵，复杂度由 O(N^2·D) 降为 O(N·rank·D)
+    """
+    if not low_rank:
+        learned_matrix = F.softmax(F.relu(torch.mm(source_embed, target_embed)), dim=1)
+        return lambda x: node_matmul(learned_matrix, x)
+    source = F.relu(source_embed)
+    target = F.relu(target_embed)
+    # 近似矩阵每行的和, shape is [node_num, 1]
+    row_sum = source.mm(target.sum(dim=1, keepdim=True)).clamp(min=1e-8)
+    return lambda x: node_matmul(source, node_matmul(target, x)) / row_sum
+
+
+# gated_residual 中 act_id 对应的激活函数
+GATE_TANH = 0
+GATE_LEAKY_RELU = 1
+GATE_RELU = 2
+
+
+@torch.jit.script
+def gated_residual(gout: torch.Tensor, adp: torch.Tensor, prev: torch.Tensor, act_id: int) -> torch.Tensor:
+    """
+    计算 act(gout) * sigmoid(adp) + prev * (1 - sigmoid(adp))，即 lerp(prev, act(gout), sigmoid(adp))
+    act_id: 0 为 tanh，1 为 leaky_relu，2 为 relu（即 GATE_TANH / GATE_LEAKY_RELU / GATE_RELU）
+    用 TorchScript 编译，能融合时逐元素运算合并为一个内核；不能融合时（如CPU）lerp 也只需一次逐元素运算
+    """
+    if act_id == 0:
+        gout = torch.tanh(gout)
+    elif act_id == 1:
+        gout = F.leaky_relu(gout)
+    else:
+        gout = F.relu(gout)
+    return torch.lerp(prev, gout, torch.sigmoid(adp))
+
+
 class Chomp1d(nn.Module):
     def __init__(self, chomp_size):
         super(Chomp1d, self).__init__()
         self.chomp_size = chomp_size
 
     def forward(self, x):
-        return x[:, :, :-self.chomp_size].contiguous()
+        # 切片后最后一维stride仍为1，后续的ReLU/Dropout/Conv1d都能直接处理，不必再拷贝一份
+        return x[:, :, :-self.chomp_size]
 
 
 class TemporalBlock(nn.Module):
@@ -165,6 +279,7 @@ class TemporalBlock(nn.Module):
         self.downsample = nn.Conv1d(n_inputs, n_outputs, 1) if n_inputs != n_outputs else None
         self.relu = nn.ReLU()
         self.init_weights()
+        self.weight_norm_fused = False
 
     def init_weights(self):
         self.conv1.weight.data.normal_(0, 0.01)
@@ -172,6 +287,16 @@ class TemporalBlock(nn.Module):
         if self.downsample is not None:
             self.downsample.weight.data.normal_(0, 0.01)
 
+    def fuse_for_inference(self):
+        """
+        把 weight_norm 的 g * v / ||v|| 合并为普通的卷积权重，之后每次forward不再重新计算权重
+        只应在训练结束后调用：合并后 state_dict 中的 weight_g/weight_v 变为 weight，与未合并的模型文件不兼容
+        """
+        if not self.weight_norm_fused:
+            remove_weight_norm(self.conv1)
+            remove_weight_norm(self.conv2)
+            self.weight_norm_fused = True
+
     def forward(self, x):
         out = self.net(x)
         res = x if self.downsample is None else self.downsample(x)
@@ -207,21 +332,87 @@ class LearnedGCN(nn.Module):
         self.target_embed = nn.Parameter(torch.Tensor(10, self.node_num))
         self.linear = nn.Linear(self.in_feature, self.out_feature)
         self.reset_parameters()
+        # 推理时缓存learned_matrix，key为两个embed参数的版本号及device/dtype，参数被原地更新（优化器、加载模型）后自动失效
+        self._cached_matrix = None
+        self._cached_key = None
 
     def reset_parameters(self):
         stdv = 1. / math.sqrt(self.source_embed.size(0))
         self.source_embed.data.uniform_(-stdv, stdv)
         self.target_embed.data.uniform_(-stdv, stdv)
 
+    def train(self, mode=True):
+        self._cached_matrix = None
+        self._cached_key = None
+        return super(LearnedGCN, self).train(mode)
+
+    def _apply(self, *args, **kwargs):
+        # .to()/.double()/.half() 等可能替换参数而不改变 _version，缓存的矩阵也不会随之转换，这里直接清空
+        self._cached_matrix = None
+        self._cached_key = None
+        return super(LearnedGCN, self)._apply(*args, **kwargs)
+
+    def get_learned_matrix(self):
+        if self.training or torch.is_grad_enabled():
+            return F.softmax(F.relu(torch.mm(self.source_embed, self.target_embed)), dim=1)
+        key = (self.source_embed._version, self.target_embed._version,
+               self.source_embed.device, self.source_embed.dtype)
+        if self._cached_key != key:
+            self._cached_matrix = F.softmax(F.relu(torch.mm(self.source_embed, self.target_embed)), dim=1)
+            self._cached_key = key
+        return self._cached_matrix
+
     def forward(self, input):
-        learned_matrix = F.softmax(F.relu(torch.mm(self.source_embed, self.target_embed)), dim=1)
-        output = learned_matrix.matmul(input)
-        output = self.linear(output)
-        return output
+        learned_matrix = self.get_learned_matrix()
+        if input.dim() == 2:
+            # [node_num, in_feature]，addmm 把矩阵乘和bias加法放在一个内核里完成
+            return torch.addmm(self.linear.bias, learned_matrix.mm(input), self.linear.weight.t())
+        # [batch, node_num, in_feature]
+        output = node_matmul(learned_matrix, input)
+        output = torch.addmm(self.linear.bias, output.view(-1, self.in_feature), self.linear.weight.t())
+        return output.view(input.shape[0], self.node_num, self.out_feature)
+
+
+class MultiHeadSelfAttention(nn.Module):
+    """
+    与 nn.MultiheadAttention 等价的自注意力（参数名一致，可直接加载旧模型），输入为 batch_first
+    torch>=2.0 时调用 F.scaled_dot_product_attention 使用融合的注意力内核，否则退回显式的 softmax(QK^T)V
+    """
+    def __init__(self, embed_dim, num_heads):
+        super(MultiHeadSelfAttention, self).__init__()
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads"
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+
+        self.in_proj_weight = nn.Parameter(torch.Tensor(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.Tensor(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.constant_(self.in_proj_bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
+
+    def forward(self, x):
+        # x shape is [batch, seq_len, embed_dim]
+        batch, length, _ = x.shape
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        # q/k/v shape is [batch, num_heads, seq_len, head_dim]
+        q, k, v = qkv.view(batch, length, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4).unbind(0)
+        if hasattr(F, 'scaled_dot_product_attention'):
+            output = F.scaled_dot_product_attention(q, k, v)
+        else:
+            scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.head_dim)
+            output = torch.matmul(F.softmax(scores, dim=-1), v)
+        output = output.transpose(1, 2).reshape(batch, length, self.embed_dim)
+        return self.out_proj(output)
 
 
 class STCell(nn.Module):
-    def __init__(self, node_num=524, seq_len=12, graph_dim=16, tcn_dim=[10], choice=[1, 1, 1], atten_head=2):
+    def __init__(self, node_num=524, seq_len=12, graph_dim=16, tcn_dim=[10], choice=[1, 1, 1], atten_head=2,
+                 low_rank_adj=False, branch_streams=False):
         super(STCell, self).__init__()
         self.node_num = node_num
         self.seq_len = seq_len
@@ -229,14 +420,18 @@ class STCell(nn.Module):
         self.tcn_dim = tcn_dim
         self.output_dim = np.sum(choice) * graph_dim
         self.choice = choice
+        self.low_rank_adj = low_rank_adj
+        self.branch_streams = branch_streams
         # self.jklayer = JumpingKnowledge("max")
         # self.jklayer = JumpingKnowledge("lstm", self.graph_dim, 1)
         self.seq_linear = nn.Linear(in_features=self.seq_len, out_features=self.seq_len)
+        # seq_linear(x) + x == F.linear(x, W + I, b)，把残差并入权重，省去一次逐元素加法
+        self.register_buffer('seq_eye', torch.eye(self.seq_len), persistent=False)
 
         if choice[0] == 1:
             print(f"[TCN]")
             print("node_num:", node_num, "\tatten_head:", atten_head)
-            self.self_atten = nn.MultiheadAttention(embed_dim=node_num, num_heads=atten_head)
+            self.self_atten = MultiHeadSelfAttention(embed_dim=node_num, num_heads=atten_head)
             self.tcn = TemporalConvNet(num_inputs=1, num_channels=self.tcn_dim)
             self.tlinear = nn.Linear(in_features=self.tcn_dim[-1] * self.seq_len, out_features=self.graph_dim)
 
@@ -280,119 +475,166 @@ class STCell(nn.Module):
             nn.init.xavier_uniform_(self.dtw_source_embed)
             nn.init.xavier_uniform_(self.dtw_target_embed)
 
+        # 各层GATConv共用的稀疏邻接矩阵缓存，每个分支只保留一项 {分支: (key, adj_t)}
+        self._adj_t_cache = {}
+        # branch_streams为True时，在GPU上每个分支使用各自的CUDA stream并行执行，首次forward时创建
+        self._branch_streams = None
+        # 启用的分支在构造时按choice确定，forward中不再逐个判断choice
+        # 只保存分支名和布尔值（不保存绑定方法），DataParallel复制模块时不会指回原模块
+        self._active = tuple(name for name, flag in zip(('tcn', 'sp', 'dtw'), choice) if flag == 1)
+        self._needs_graph_input = 'sp' in self._active or 'dtw' in self._active
+        # 原实现中DTW分支在SP分支已更新过的x上再做一次seq_linear残差，这里保持相同的计算
+        self._dtw_double_residual = 'sp' in self._active and 'dtw' in self._active
+
+    def _get_adj_t(self, branch, edge_index, num_nodes):
+        """
+        将边集转换为 SparseTensor 形式的 adj_t 并缓存，4层GATConv共用，省去每层每个batch对 edge_index
+        做 remove_self_loops/add_self_loops（GATConv 对 adj_t 仍会逐层调用 set_diag 添加自环）
+        torch_sparse 不可用时直接返回原边集
+        """
+        if SparseTensor is None:
+            return edge_index
+        # 边集张量本身（地址与版本号）也作为key的一部分，边集被替换或原地修改后缓存自动失效
+        key = (num_nodes, edge_index.device, edge_index.data_ptr(), edge_index._version)
+        cached = self._adj_t_cache.get(branch)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        # GATConv 的消息从 edge_index[0] 流向 edge_index[1]，adj_t 的行对应目标节点
+        adj_t = SparseTensor(row=edge_index[1], col=edge_index[0], sparse_sizes=(num_nodes, num_nodes))
+        self._adj_t_cache[branch] = (key, adj_t)
+        return adj_t
+
+    def _apply(self, *args, **kwargs):
+        # model.to()/cuda() 等会搬运参数和buffer，缓存的adj_t不会随之移动，这里直接清空，下次forward时重建
+        self._adj_t_cache = {}
+        return super(STCell, self)._apply(*args, **kwargs)
+
+    def _tcn_branch(self, x):
+        # atten_input shape is [batch, seq_len, node_num]
+        atten_input = x.reshape(-1, self.node_num, self.seq_len).transpose(1, 2)
+        atten_output = self.self_atten(atten_input)
+        atten_output = torch.tanh(atten_output + atten_input)
+        atten_output = atten_output.transpose(1, 2).reshape(-1, self.seq_len)
+
+        tcn_input = atten_output.unsqueeze(1)
+        tcn_output = self.tcn(tcn_input)
+        tcn_output = torch.reshape(tcn_output, (tcn_output.shape[0], self.tcn_dim[-1] * self.seq_len))
+        tcn_output = self.tlinear(tcn_output)
+        tcn_output = torch.reshape(tcn_output, (-1, self.node_num, self.graph_dim))
+        return tcn_output
+
+    def _sp_branch(self, x, edge_index):
+        sp_adj_t = self._get_adj_t('sp', edge_index, x.shape[0])
+        sp_propagate = learned_propagation(self.sp_source_embed, self.sp_target_embed, self.low_rank_adj)
+
+        # the gates run on [batch, node_num, dim]; only GATConv gets the flat [batch*node_num, dim] view
+        x_3d = x.view(-1, self.node_num, self.seq_len)
+        sp_gout_1 = self.sp_gconv1(x, sp_adj_t).view(-1, self.node_num, self.graph_dim)
+        sp_adp_1 = self.sp_linear_1(sp_propagate(F.dropout(x_3d, p=0.1, training=self.training)))
+        sp_origin = self.sp_origin(x_3d)
+        sp_output_1 = gated_residual(sp_gout_1, sp_adp_1, sp_origin, GATE_TANH)
+
+        sp_act_1 = torch.tanh(sp_output_1)
+        sp_gout_2 = self.sp_gconv2(sp_act_1.view(-1, self.graph_dim), sp_adj_t).view_as(sp_act_1)
+        sp_adp_2 = self.sp_linear_2(sp_propagate(F.dropout(sp_act_1, p=0.1, training=self.training)))
+        sp_output_2 = gated_residual(sp_gout_2, sp_adp_2, sp_output_1, GATE_LEAKY_RELU)
+
+        sp_act_2 = F.relu(sp_output_2)
+        sp_gout_3 = self.sp_gconv3(sp_act_2.view(-1, self.graph_dim), sp_adj_t).view_as(sp_act_2)
+        sp_adp_3 = self.sp_linear_3(sp_propagate(F.dropout(sp_act_2, p=0.1, training=self.training)))
+        sp_output_3 = gated_residual(sp_gout_3, sp_adp_3, sp_output_2, GATE_RELU)
+
+        sp_act_3 = F.relu(sp_output_3)
+        sp_gout_4 = self.sp_gconv4(sp_act_3.view(-1, self.graph_dim), sp_adj_t).view_as(sp_act_3)
+        sp_adp_4 = self.sp_linear_4(sp_propagate(F.dropout(sp_act_3, p=0.1, training=self.training)))
+        sp_output_4 = gated_residual(sp_gout_4, sp_adp_4, sp_output_3, GATE_RELU)
+
+        # sp_gout_5 = self.sp_gconv5(F.relu(sp_output_4), edge_index)
+        # adp_input_5 = torch.reshape(F.relu(sp_output_4), (-1, self.node_num, self.graph_dim))
+        # sp_adp_5 = self.sp_linear_5(sp_learned_matrix.matmul(F.dropout(adp_input_5,p=0.1)))
+        # sp_adp_5 = torch.reshape(sp_adp_5, (-1, self.graph_dim))
+        # sp_output_5 = F.relu(sp_gout_5) * torch.sigmoid(sp_adp_5) + sp_output_4 * (1 - torch.sigmoid(sp_adp_5))
+
+        return sp_output_4
+
+    def _dtw_branch(self, x, dtw_edge_index):
+        dtw_adj_t = self._get_adj_t('dtw', dtw_edge_index, x.shape[0])
+        dtw_propagate = learned_propagation(self.dtw_source_embed, self.dtw_target_embed, self.low_rank_adj)
+
+        x_3d = x.view(-1, self.node_num, self.seq_len)
+        dtw_gout_1 = self.dtw_gconv1(x, dtw_adj_t).view(-1, self.node_num, self.graph_dim)
+        dtw_adp_1 = self.dtw_linear_1(dtw_propagate(F.dropout(x_3d, p=0.1, training=self.training)))
+        dtw_origin = self.dtw_origin(x_3d)
+        dtw_output_1 = gated_residual(dtw_gout_1, dtw_adp_1, dtw_origin, GATE_TANH)
+
+        dtw_act_1 = torch.tanh(dtw_output_1)
+        dtw_gout_2 = self.dtw_gconv2(dtw_act_1.view(-1, self.graph_dim), dtw_adj_t).view_as(dtw_act_1)
+        dtw_adp_2 = self.dtw_linear_2(dtw_propagate(F.dropout(dtw_act_1, p=0.1, training=self.training)))
+        dtw_output_2 = gated_residual(dtw_gout_2, dtw_adp_2, dtw_output_1, GATE_LEAKY_RELU)
+
+        dtw_act_2 = F.relu(dtw_output_2)
+        dtw_gout_3 = self.dtw_gconv3(dtw_act_2.view(-1, self.graph_dim), dtw_adj_t).view_as(dtw_act_2)
+        dtw_adp_3 = self.dtw_linear_3(dtw_propagate(F.dropout(dtw_act_2, p=0.1, training=self.training)))
+        dtw_output_3 = gated_residual(dtw_gout_3, dtw_adp_3, dtw_output_2, GATE_RELU)
+
+        dtw_act_3 = F.relu(dtw_output_3)
+        dtw_gout_4 = self.dtw_gconv4(dtw_act_3.view(-1, self.graph_dim), dtw_adj_t).view_as(dtw_act_3)
+        dtw_adp_4 = self.dtw_linear_4(dtw_propagate(F.dropout(dtw_act_3, p=0.1, training=self.training)))
+        dtw_output_4 = gated_residual(dtw_gout_4, dtw_adp_4, dtw_output_3, GATE_RELU)
+
+        # dtw_gout_5 = self.dtw_gconv5(F.relu(dtw_output_4), dtw_edge_index)
+        # adp_input_5 = torch.reshape(F.relu(dtw_output_4), (-1, self.node_num, self.graph_dim))
+        # dtw_adp_5 = self.dtw_linear_5(dtw_learned_matrix.matmul(F.dropout(adp_input_5,p=0.1)))
+        # dtw_adp_5 = torch.reshape(dtw_adp_5, (-1, self.graph_dim))
+        # dtw_output_5 = \
+        # F.relu(dtw_gout_5) * torch.sigmoid(dtw_adp_5) + dtw_output_4 * (1 - torch.sigmoid(dtw_adp_5))
+
+        return dtw_output_4
+
+    def _run_branches_on_streams(self, branch_inputs, device):
+        """
+        各分支互不依赖，分别放到独立的CUDA stream上执行，使注意力+TCN与两路GAT的内核可以重叠
+        """
+        current_stream = torch.cuda.current_stream(device)
+        if self._branch_streams is None or self._branch_streams[0].device != device:
+            self._branch_streams = [torch.cuda.Stream(device=device) for _ in self._active]
+
+        output_list = []
+        for name, stream in zip(self._active, self._branch_streams):
+            # 等待当前stream上x等输入计算完成后再开始
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                output_list.append(getattr(self, '_{}_branch'.format(name))(*branch_inputs[name]))
+        for output, stream in zip(output_list, self._branch_streams):
+            current_stream.wait_stream(stream)
+            # 输出在分支stream上分配、在当前stream上使用，告知缓存分配器以免内存被提前复用
+            output.record_stream(current_stream)
+        return output_list
+
     def forward(self, x, edge_index, dtw_edge_index):
         # x shape is [batch*node_num, seq_len]
         # tcn/dtw/sp/adaptive output shape is [batch, node_num, graph_dim]
-        output_list = [0, 0, 0]
-
-        if self.choice[0] == 1:
-            atten_input = torch.reshape(x, (-1, self.node_num, self.seq_len)).permute(2, 0, 1)
-            atten_output, _ = self.self_atten(atten_input, atten_input, atten_input)
-            atten_output = torch.tanh(atten_output + atten_input)
-            atten_output = torch.reshape(atten_output.permute(1, 2, 0), (-1, self.seq_len))
-
-            tcn_input = atten_output.unsqueeze(1)
-            tcn_output = self.tcn(tcn_input)
-            tcn_output = torch.reshape(tcn_output, (tcn_output.shape[0], self.tcn_dim[-1] * self.seq_len))
-            tcn_output = self.tlinear(tcn_output)
-            tcn_output = torch.reshape(tcn_output, (-1, self.node_num, self.graph_dim))
-            output_list[0] = tcn_output
-
-        if self.choice[1] == 1:
-            x = self.seq_linear(x) + x
-
-            sp_learned_matrix = F.softmax(F.relu(torch.mm(self.sp_source_embed, self.sp_target_embed)), dim=1)
-
-            sp_gout_1 = self.sp_gconv1(x, edge_index)
-            adp_input_1 = torch.reshape(x, (-1, self.node_num, self.seq_len))
-            sp_adp_1 = self.sp_linear_1(sp_learned_matrix.matmul(F.dropout(adp_input_1, p=0.1)))
-            sp_adp_1 = torch.reshape(sp_adp_1, (-1, self.graph_dim))
-            sp_origin = self.sp_origin(x)
-            sp_output_1 = torch.tanh(sp_gout_1) * torch.sigmoid(sp_adp_1) + sp_origin * (1 - torch.sigmoid(sp_adp_1))
-
-            sp_gout_2 = self.sp_gconv2(torch.tanh(sp_output_1), edge_index)
-            adp_input_2 = torch.reshape(torch.tanh(sp_output_1), (-1, self.node_num, self.graph_dim))
-            sp_adp_2 = self.sp_linear_2(sp_learned_matrix.matmul(F.dropout(adp_input_2, p=0.1)))
-            sp_adp_2 = torch.reshape(sp_adp_2, (-1, self.graph_dim))
-            sp_output_2 = F.leaky_relu(sp_gout_2) * torch.sigmoid(sp_adp_2) \
-                + sp_output_1 * (1 - torch.sigmoid(sp_adp_2))
-
-            sp_gout_3 = self.sp_gconv3(F.relu(sp_output_2), edge_index)
-            adp_input_3 = torch.reshape(F.relu(sp_output_2), (-1, self.node_num, self.graph_dim))
-            sp_adp_3 = self.sp_linear_3(sp_learned_matrix.matmul(F.dropout(adp_input_3, p=0.1)))
-            sp_adp_3 = torch.reshape(sp_adp_3, (-1, self.graph_dim))
-            sp_output_3 = F.relu(sp_gout_3) * torch.sigmoid(sp_adp_3) + sp_output_2 * (1 - torch.sigmoid(sp_adp_3))
-
-            sp_gout_4 = self.sp_gconv4(F.relu(sp_output_3), edge_index)
-            adp_input_4 = torch.reshape(F.relu(sp_output_3), (-1, self.node_num, self.graph_dim))
-            sp_adp_4 = self.sp_linear_4(sp_learned_matrix.matmul(F.dropout(adp_input_4, p=0.1)))
-            sp_adp_4 = torch.reshape(sp_adp_4, (-1, self.graph_dim))
-            sp_output_4 = F.relu(sp_gout_4) * torch.sigmoid(sp_adp_4) + sp_output_3 * (1 - torch.sigmoid(sp_adp_4))
-
-            # sp_gout_5 = self.sp_gconv5(F.relu(sp_output_4), edge_index)
-            # adp_input_5 = torch.reshape(F.relu(sp_output_4), (-1, self.node_num, self.graph_dim))
-            # sp_adp_5 = self.sp_linear_5(sp_learned_matrix.matmul(F.dropout(adp_input_5,p=0.1)))
-            # sp_adp_5 = torch.reshape(sp_adp_5, (-1, self.graph_dim))
-            # sp_output_5 = F.relu(sp_gout_5) * torch.sigmoid(sp_adp_5) + sp_output_4 * (1 - torch.sigmoid(sp_adp_5))
-
-            sp_output = torch.reshape(sp_output_4, (-1, self.node_num, self.graph_dim))
-            # sp_output = sp_output_4
-            output_list[1] = sp_output
-
-        if self.choice[2] == 1:
-            x = self.seq_linear(x) + x
-
-            dtw_learned_matrix = F.softmax(F.relu(torch.mm(self.dtw_source_embed, self.dtw_target_embed)), dim=1)
-
-            dtw_gout_1 = self.dtw_gconv1(x, dtw_edge_index)
-            adp_input_1 = torch.reshape(x, (-1, self.node_num, self.seq_len))
-            dtw_adp_1 = self.dtw_linear_1(dtw_learned_matrix.matmul(F.dropout(adp_input_1, p=0.1)))
-            dtw_adp_1 = torch.reshape(dtw_adp_1, (-1, self.graph_dim))
-            dtw_origin = self.dtw_origin(x)
-            dtw_output_1 = torch.tanh(dtw_gout_1) * torch.sigmoid(dtw_adp_1) + \
-                dtw_origin * (1 - torch.sigmoid(dtw_adp_1))
-
-            dtw_gout_2 = self.dtw_gconv2(torch.tanh(dtw_output_1), dtw_edge_index)
-            adp_input_2 = torch.reshape(torch.tanh(dtw_output_1), (-1, self.node_num, self.graph_dim))
-            dtw_adp_2 = self.dtw_linear_2(dtw_learned_matrix.matmul(F.dropout(adp_input_2, p=0.1)))
-            dtw_adp_2 = torch.reshape(dtw_adp_2, (-1, self.graph_dim))
-            dtw_output_2 = F.leaky_relu(dtw_gout_2) * torch.sigmoid(dtw_adp_2) + \
-                dtw_output_1 * (1 - torch.sigmoid(dtw_adp_2))
-
-            dtw_gout_3 = self.dtw_gconv3(F.relu(dtw_output_2), dtw_edge_index)
-            adp_input_3 = torch.reshape(F.relu(dtw_output_2), (-1, self.node_num, self.graph_dim))
-            dtw_adp_3 = self.dtw_linear_3(dtw_learned_matrix.matmul(F.dropout(adp_input_3, p=0.1)))
-            dtw_adp_3 = torch.reshape(dtw_adp_3, (-1, self.graph_dim))
-            dtw_output_3 = F.relu(dtw_gout_3) * torch.sigmoid(dtw_adp_3) + dtw_output_2 * (1 - torch.sigmoid(dtw_adp_3))
-
-            dtw_gout_4 = self.dtw_gconv4(F.relu(dtw_output_3), dtw_edge_index)
-            adp_input_4 = torch.reshape(F.relu(dtw_output_3), (-1, self.node_num, self.graph_dim))
-            dtw_adp_4 = self.dtw_linear_4(dtw_learned_matrix.matmul(F.dropout(adp_input_4, p=0.1)))
-            dtw_adp_4 = torch.reshape(dtw_adp_4, (-1, self.graph_dim))
-            dtw_output_4 = F.relu(dtw_gout_4) * torch.sigmoid(dtw_adp_4) + dtw_output_3 * (1 - torch.sigmoid(dtw_adp_4))
-
-            # dtw_gout_5 = self.dtw_gconv5(F.relu(dtw_output_4), dtw_edge_index)
-            # adp_input_5 = torch.reshape(F.relu(dtw_output_4), (-1, self.node_num, self.graph_dim))
-            # dtw_adp_5 = self.dtw_linear_5(dtw_learned_matrix.matmul(F.dropout(adp_input_5,p=0.1)))
-            # dtw_adp_5 = torch.reshape(dtw_adp_5, (-1, self.graph_dim))
-            # dtw_output_5 = \
-            # F.relu(dtw_gout_5) * torch.sigmoid(dtw_adp_5) + dtw_output_4 * (1 - torch.sigmoid(dtw_adp_5))
-
-            dtw_output = torch.reshape(dtw_output_4, (-1, self.node_num, self.graph_dim))
-            # dtw_output = dtw_output_4
-            output_list[2] = dtw_output
-
-        step = 0
-        for i in range(len(self.choice)):
-            if self.choice[i] == 1 and step == 0:
-                cell_output = output_list[i]
-                step += 1
-            elif self.choice[i] == 1:
-                cell_output = torch.cat((cell_output, output_list[i]), dim=2)
+        graph_input = dtw_input = None
+        if self._needs_graph_input:
+            # seq_linear(x) + x == F.linear(x, W + I, b)，W + I 每次forward只构造一次，两个图分支共用
+            seq_weight = self.seq_linear.weight + self.seq_eye
+            graph_input = F.linear(x, seq_weight, self.seq_linear.bias)
+            dtw_input = F.linear(graph_input, seq_weight, self.seq_linear.bias) \
+                if self._dtw_double_residual else graph_input
+
+        # 先准备好各分支的输入，之后各分支互不依赖
+        branch_inputs = {'tcn': (x,), 'sp': (graph_input, edge_index), 'dtw': (dtw_input, dtw_edge_index)}
+        if self.branch_streams and x.is_cuda and len(self._active) > 1:
+            output_list = self._run_branches_on_streams(branch_inputs, x.device)
+        else:
+            output_list = [getattr(self, '_{}_branch'.format(name))(*branch_inputs[name]) for name in self._active]
+
+        # 各分支输出均为 [batch, node_num, graph_dim]，一次cat完成拼接，避免逐个cat的重复分配
+        cell_output = torch.cat(output_list, dim=2)
 
         # cell_output = self.jklayer([output_list[0], output_list[1], output_list[2]])
         # cell_output = self.out(cell_output)
 
-        cell_output = torch.reshape(cell_output, (-1, self.output_dim))
+        cell_output = cell_output.view(-1, self.output_dim)
 
         return cell_output